@@ -0,0 +1,50 @@
+import ahocorasick
+
+# ======================================================
+# KEYWORD ROUTER
+# Kept free of model imports so it loads (and can be
+# tested) without torch or the embedder.
+# ======================================================
+
+# Unambiguous keywords per tool. They are compiled into one Aho-Corasick
+# automaton, which finds every keyword in a single O(len(text)) pass
+# and routes these messages without running the embedder at all.
+ROUTE_KEYWORDS = {
+    "SuicideHelp": ("kill myself", "want to die", "suicide", "end my life"),
+    "PositivePrompt": ("stressed", "pressure", "tired", "overwhelmed"),
+    "NegativePrompt": ("worried", "scared", "anxious", "fear"),
+    "StudentMarks": ("mark", "marks", "score", "scores", "result", "results"),
+}
+
+_ROUTE_AC = ahocorasick.Automaton()
+for _tool_name, _words in ROUTE_KEYWORDS.items():
+    for _word in _words:
+        _ROUTE_AC.add_word(_word, (_tool_name, len(_word)))
+_ROUTE_AC.make_automaton()
+
+
+def _is_word(text, start, end):
+    """
+    True if text[start:end + 1] is a whole word, not part of a longer one
+    """
+    return (
+        (start == 0 or not text[start - 1].isalnum())
+        and (end + 1 == len(text) or not text[end + 1].isalnum())
+    )
+
+
+def keyword_route(user):
+    """
+    Return the tool for the first keyword in the message, or None.
+    Crisis phrases win over any other keyword in the same message.
+    """
+    text = user.lower()
+    found = None
+    for end, (tool_name, length) in _ROUTE_AC.iter(text):
+        # Crisis phrases match anywhere in the text
+        if tool_name == "SuicideHelp":
+            return tool_name
+        # Other keywords must be whole words ("market" is not "mark")
+        if found is None and _is_word(text, end - length + 1, end):
+            found = tool_name
+    return found
@@ -1,18 +1,59 @@
 # main.py
 
-from fastapi import FastAPI
+import asyncio
+import importlib
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import uvicorn
+from fastapi import BackgroundTasks, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 
-# Import router logic + global history + session id
-from router_logic import process_message, conversation_history, SESSION_ID
+# Router logic (models, tools, history) is imported by the lifespan,
+# i.e. once inside each worker. `python main.py` only runs the uvicorn
+# supervisor, which must not load (or compile) the models itself.
+router_logic = None
+
+# ======================================================
+# LIFESPAN
+# Loads the router logic when the app boots, starts the
+# LLM + embedding micro-batchers and stops them on shutdown.
+# Torch threads are split across the workers and the
+# concurrent generate calls each worker allows, so the
+# host's cores are not oversubscribed.
+# ======================================================
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global router_logic
+    router_logic = importlib.import_module("router_logic")
+
+    import torch    # Already loaded by router_logic
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // (workers * router_logic.LLM_SLOTS)))
+
+    batchers = [
+        asyncio.create_task(router_logic.llm_batcher()),
+        asyncio.create_task(router_logic.embed_batcher())
+    ]
+    yield
+    for batcher in batchers:
+        batcher.cancel()
 
 # ======================================================
 # FASTAPI APP INITIALIZATION
+# JSON responses are encoded with orjson (much faster than
+# stdlib json on large lists like /history).
 # ======================================================
-app = FastAPI(title="Intelligent Chatbot API")
+app = FastAPI(
+    title="Intelligent Chatbot API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # ======================================================
 # ENABLE CORS (Cross-Origin Resource Sharing)
@@ -27,28 +68,27 @@ app.add_middleware(
     allow_headers=["*"],      # Allow all headers
 )
 
-# ======================================================
-# SERVE STATIC FRONTEND FILES
-# This allows files in /frontend to be accessible via /static/...
-# Example: index.html, style.css, app.js
-# ======================================================
-app.mount("/static", StaticFiles(directory="frontend"), name="static")
-
-# ======================================================
-# SERVE MAIN HTML PAGE
-# Visiting http://localhost:8000/ will return index.html
-# ======================================================
-@app.get("/")
-def root():
-    return FileResponse("frontend/index.html")
-
 # ======================================================
 # PYDANTIC MODEL: CHAT REQUEST
 # This ensures POST /chat request must contain JSON:
 # { "message": "user message here" }
+# Optionally with "session_id" (from a previous response)
+# to keep per-conversation context.
 # ======================================================
 class Query(BaseModel):
     message: str
+    session_id: Optional[str] = None
+
+# ======================================================
+# SSE HELPER
+# Wraps process_message_stream events as Server-Sent Events
+# ======================================================
+def sse_response(q: Query):
+    async def events():
+        async for event in router_logic.process_message_stream(q.message, q.session_id):
+            yield f"data: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 # ======================================================
 # CHAT API ENDPOINT
@@ -56,19 +96,42 @@ class Query(BaseModel):
 # 1. Receives user message
 # 2. Sends to intelligent router (process_message)
 # 3. Returns JSON: session_id, tool_used, response
+# Clients sending "Accept: text/event-stream" get the
+# streamed reply instead (same events as /chat/stream).
 # ======================================================
 @app.post("/chat")
-def chat(q: Query):
+async def chat(q: Query, request: Request, background_tasks: BackgroundTasks):
     """
     POST /chat
-    Request: { "message": "..." }
+    Request: { "message": "...", "session_id": "..." (optional) }
     Response: { "session_id": "...", "tool": "...", "response": "..." }
     """
-    return process_message(q.message)
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return sse_response(q)
+    return await router_logic.process_message(q.message, q.session_id, background_tasks)
+
+# ======================================================
+# STREAMING CHAT API
+# Same as /chat, but streams the reply as Server-Sent Events
+# while the LLM is generating, so the client sees text
+# immediately instead of waiting for the whole response.
+# ======================================================
+@app.post("/chat/stream")
+async def chat_stream(q: Query):
+    """
+    POST /chat/stream
+    Request: { "message": "...", "session_id": "..." (optional) }
+    Response (text/event-stream):
+        data: { "session_id": "...", "tool": "..." }
+        data: { "delta": "..." }                    (repeated)
+        data: { "response": "...", "done": true }
+        (or data: { "error": "..." } if generation fails mid-stream)
+    """
+    return sse_response(q)
 
 # ======================================================
 # FULL HISTORY API
-# Returns all past conversations for this session.
+# Returns past conversations (most recent 1000).
 # Each entry contains:
 # - session_id
 # - user_message
@@ -77,7 +140,7 @@ def chat(q: Query):
 # Useful for Postman testing or analytics.
 # ======================================================
 @app.get("/history")
-def history():
+async def history():
     """
     GET /history
     Response: [
@@ -90,7 +153,7 @@ def history():
         ...
     ]
     """
-    return conversation_history
+    return await router_logic.get_history()
 
 # ======================================================
 # LAST MESSAGE ONLY
@@ -98,7 +161,7 @@ def history():
 # Useful if frontend only wants the latest response
 # ======================================================
 @app.get("/history/latest")
-def last():
+async def last():
     """
     GET /history/latest
     Response:
@@ -109,6 +172,45 @@ def last():
             "tool_used": "..."
         }
     """
-    if len(conversation_history) == 0:
+    entry = await router_logic.get_latest()
+    if entry is None:
         return {"message": "No history yet"}
-    return conversation_history[-1]
+    return entry
+
+# ======================================================
+# SERVE FRONTEND
+# Files in /frontend are served from the site root, and
+# visiting http://localhost:8000/ returns index.html.
+# StaticFiles sends ETag/Last-Modified so browsers get 304s.
+# Mounted last so the API routes above take priority.
+# ======================================================
+app.mount("/", StaticFiles(directory="frontend", html=True), name="frontend")
+
+# ======================================================
+# ENTRYPOINT
+# `python main.py` runs several worker processes (WEB_CONCURRENCY,
+# default 4) on uvloop + httptools to use all CPU cores.
+# With LLM_BACKEND=vllm a single worker is used: each worker would
+# build its own engine claiming most of the GPU memory.
+# NOTE: set REDIS_URL so /history is shared by all workers;
+# without it each worker only sees the turns it handled.
+# Per-session routing context and both reply caches always live
+# in each worker, so without sticky routing (same session → same
+# worker) follow-up messages can lose their context.
+# ======================================================
+if __name__ == "__main__":
+    if os.getenv("LLM_BACKEND", "hf") == "vllm":
+        workers = 1
+    else:
+        workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+    # Workers read this to size their torch thread pools
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools"
+    )
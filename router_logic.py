@@ -1,98 +1,631 @@
-import torch, re, random, uuid
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import torch, re, uuid, asyncio, os, copy, json, importlib.util
+import redis.asyncio as redis
+import numpy as np
+from collections import deque, OrderedDict
+from functools import lru_cache
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig,
+    StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+)
 from sentence_transformers import SentenceTransformer, util
-from langchain.memory import ConversationBufferMemory
 from langchain_community.tools import Tool
+from langchain_core.messages import AIMessage, HumanMessage
+from keyword_routing import keyword_route
 
 # ======================================================
 # GLOBALS
 # ======================================================
 
-# Unique session identifier for this chat session
-SESSION_ID = str(uuid.uuid4())
-
-# Stores every chat step in memory (user + AI + tool used)
-conversation_history = []
+# Stores the most recent chat steps (user + AI + tool used);
+# oldest entries are evicted automatically beyond HISTORY_SIZE.
+# With REDIS_URL set, history lives in a Redis list shared by all
+# uvicorn workers; otherwise it is kept in this process's memory.
+HISTORY_SIZE = 1000
+HISTORY_KEY = "chat:history"
+REDIS_URL = os.getenv("REDIS_URL")
+history_store = redis.from_url(REDIS_URL) if REDIS_URL else None
+conversation_history = deque(maxlen=HISTORY_SIZE)
+
+# Semantic response cache, one per tool so a reply is only reused for
+# the tool that produced it: tool → (embeddings of past LLM queries
+# (N×384), the responses generated for them), evicted FIFO
+CACHE_SIZE = 512
+CACHE_THRESHOLD = 0.9
+_semantic_cache = {}
+
+# Exact-match response cache (LRU) checked before the semantic cache,
+# so verbatim repeats skip even the embedding pass. Keyed by
+# (tool, normalized message); replies are sampled, so a hit trades
+# novelty for speed, just like the semantic cache.
+EXACT_CACHE_SIZE = 4096
+_exact_cache = OrderedDict()
+
+# Tools that answer without the LLM (canned or random text): they skip
+# the semantic cache and conversation memory entirely
+DIRECT_TOOLS = {"SuicideHelp", "StudentMarks"}
 
 # ======================================================
 # LOAD MODELS
 # ======================================================
 
-# Embedding model to compute semantic similarity for intelligent routing
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
-
-# Small Qwen LLM (0.5B) for generating responses
-tokenizer = AutoTokenizer.from_pretrained("Qwen/Qwen2.5-0.5B-Instruct")
-model = AutoModelForCausalLM.from_pretrained(
-    "Qwen/Qwen2.5-0.5B-Instruct",
-    torch_dtype=torch.float16,   # Use half-precision to save memory
-    device_map="cpu"             # Run on CPU
+# Shared on-disk cache for all model weights (optional), so every uvicorn
+# worker loads the same downloaded files. Each worker still holds its own
+# in-memory copy of the models (weights are cast/quantized at load time),
+# so memory use grows with the number of workers.
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR")
+LLM_ID = "Qwen/Qwen2.5-0.5B-Instruct"
+
+# Embedding model to compute semantic similarity for intelligent routing.
+# Runs on ONNX Runtime using the fp32, O3 graph-optimized export that ships
+# with the model, so scores match the fp32 model the routing (0.4) and
+# cache (CACHE_THRESHOLD) similarity thresholds were chosen for.
+# int8 exports are opt-in via EMBEDDER_ONNX_FILE and must match the CPU
+# (onnx/model_qint8_avx512_vnni.onnx, model_quint8_avx2.onnx,
+# model_qint8_arm64.onnx); re-check the thresholds if you switch.
+embedder = SentenceTransformer(
+    "all-MiniLM-L6-v2",
+    cache_folder=MODEL_CACHE_DIR,
+    backend="onnx",
+    model_kwargs={
+        "file_name": os.getenv("EMBEDDER_ONNX_FILE", "onnx/model_O3.onnx")
+    }
 )
 
-# LangChain conversation memory to store AI/user messages internally
-memory = ConversationBufferMemory(return_messages=True)
+# LLM backend for the Qwen model:
+# - "hf" (default): transformers on CPU, batched by the micro-batcher below
+# - "vllm": vLLM engine (GPU) with PagedAttention, continuous batching and
+#   automatic prefix caching; run a single uvicorn worker per GPU with it
+LLM_BACKEND = os.getenv("LLM_BACKEND", "hf")
+
+# Prompt template: PROMPT_PREFIX + " " + query + PROMPT_SUFFIX.
+# The fixed parts are built once (and tokenized once on the HF path).
+PROMPT_PREFIX = "User:"
+PROMPT_SUFFIX = "\nAssistant:"
+
+if LLM_BACKEND == "vllm":
+    from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+    from vllm.sampling_params import RequestOutputKind
+
+    engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(
+        model=LLM_ID,
+        download_dir=MODEL_CACHE_DIR,
+        gpu_memory_utilization=0.9,
+        enable_prefix_caching=True,  # Shared "User: ..." prefix hits the block cache
+        # Prompt-lookup (n-gram) speculative decoding, no draft model needed
+        speculative_config={"method": "ngram", "num_speculative_tokens": 5, "prompt_lookup_max": 4}
+    ))
+else:
+    # Small Qwen LLM (0.5B) for generating responses
+    tokenizer = AutoTokenizer.from_pretrained(
+        LLM_ID,
+        cache_dir=MODEL_CACHE_DIR,
+        use_fast=True                # Rust tokenizers backend
+    )
+    # Fused attention kernels: FlashAttention-2 when installed (GPU only),
+    # otherwise PyTorch SDPA, which is fused on both CPU and GPU
+    if torch.cuda.is_available() and importlib.util.find_spec("flash_attn"):
+        ATTN_IMPL = "flash_attention_2"
+    else:
+        ATTN_IMPL = "sdpa"
+
+    if torch.cuda.is_available():
+        # GPU: 4-bit NF4 weights (bitsandbytes) with bf16 compute; decode is
+        # bandwidth-bound, so ~4x fewer weight bytes per token
+        model = AutoModelForCausalLM.from_pretrained(
+            LLM_ID,
+            cache_dir=MODEL_CACHE_DIR,
+            device_map="auto",
+            use_safetensors=True,
+            torch_dtype=torch.bfloat16,  # Non-quantized layers (embeddings, norms) in bf16
+            attn_implementation=ATTN_IMPL,
+            quantization_config=BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16
+            )
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            LLM_ID,
+            cache_dir=MODEL_CACHE_DIR,
+            torch_dtype=torch.float32,   # Dynamic quantization needs fp32 weights
+            device_map="cpu",            # Run on CPU
+            attn_implementation=ATTN_IMPL,
+            use_safetensors=True,        # Load safetensors, not pickled .bin files
+            low_cpu_mem_usage=True       # Don't materialize a second copy while loading
+        )
+
+        # INT8 weight quantization of all Linear layers: halves weight bandwidth
+        # vs fp16 and uses int8 dot-product kernels (VNNI) on CPU
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    # The "User:" prefix and "\nAssistant:" suffix are constant: tokenize them once
+    PREFIX_IDS = tokenizer(PROMPT_PREFIX, add_special_tokens=False).input_ids
+    SUFFIX_IDS = tokenizer(PROMPT_SUFFIX, add_special_tokens=False).input_ids
+
+# Generation settings: replies are short supportive messages, so cap
+# them at 64 new tokens. Greedy decoding is used when the router is
+# confident about the tool; otherwise sample for more varied replies.
+MAX_NEW_TOKENS = 64
+SAMPLING = {"do_sample": True, "temperature": 0.6, "top_p": 0.9}
+GREEDY = {"do_sample": False, "num_beams": 1}
+GREEDY_CONFIDENCE = 0.6
+
+# Prompt-lookup decoding: draft tokens are copied from n-grams of the
+# prompt and verified in one forward pass, so several tokens can be
+# accepted per step (output distribution is unchanged). HF only
+# supports it for a single sequence, so batched calls skip it.
+PROMPT_LOOKUP_TOKENS = 10
+
+# Optional (LLM_COMPILE=1): static KV-cache + torch.compile'd forward, so
+# each decode step runs one compiled graph (a CUDA graph on GPU). The static
+# cache replaces prompt-lookup decoding, which needs a dynamic cache.
+# Compile cost is paid by warm-up calls at startup (see MICRO-BATCHERS).
+COMPILE_LLM = LLM_BACKEND == "hf" and os.getenv("LLM_COMPILE") == "1"
+
+# Compiled graphs are specialized on shapes, so with LLM_COMPILE=1 every
+# prompt is padded into a fixed bucket: batch size rounded up to a power of
+# two, prompt width to a multiple of PROMPT_BUCKET tokens
+PROMPT_BUCKET = 64
+
+if COMPILE_LLM:
+    model.generation_config.cache_implementation = "static"
+    model.forward = torch.compile(
+        model.forward,
+        mode="reduce-overhead" if torch.cuda.is_available() else "default"
+    )
+
+# Bake the generation settings into GenerationConfigs once, instead of
+# passing sampling kwargs that generate() re-parses and validates per call
+if LLM_BACKEND == "hf":
+    model.generation_config.update(
+        max_new_tokens=MAX_NEW_TOKENS,
+        pad_token_id=tokenizer.eos_token_id,
+        **SAMPLING
+    )
+    SAMPLING_CONFIG = model.generation_config
+    GREEDY_CONFIG = copy.deepcopy(SAMPLING_CONFIG)
+    GREEDY_CONFIG.update(temperature=None, top_p=None, top_k=None, **GREEDY)
+
+# Conversation memory per session: ring buffer of recent
+# ("user" | "ai", text) messages, used as routing context.
+# Kept in LRU order; the least recently used sessions are
+# dropped beyond MAX_SESSIONS so memory stays bounded.
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "10000"))
+SESSION_TURNS = 32
+SESSIONS = OrderedDict()
 
 # ======================================================
 # UTILITIES
 # ======================================================
 
+# Any run of | symbols, whitespace and "User:" / "Assistant:" labels
+_CLEAN_RE = re.compile(r"(?:[\s|]|(?:User|Assistant):)+")
+_LABELS_RE = re.compile(r"(?:(?:User|Assistant):)+")
+
+
+def _clean_run(m):
+    # Labels alone vanish; anything with a | or whitespace becomes one space
+    return "" if _LABELS_RE.fullmatch(m.group(0)) else " "
+
+
 def clean(text):
     """
-    Clean AI output:
+    Clean AI output in a single regex pass:
     - Remove | symbols
     - Remove "User:" / "Assistant:" labels
     - Remove extra spaces
     """
     if not text:
         return ""
-    text = text.replace("|", " ")
-    text = re.sub(r"(User|Assistant):", "", text)
-    return re.sub(r"\s+", " ", text).strip()
+    return _CLEAN_RE.sub(_clean_run, text).strip()
+
+
+@lru_cache(maxsize=4096)
+def query_ids(query):
+    """
+    Token ids of the variable part of the prompt (" " + query),
+    memoized for repeated messages
+    """
+    return tuple(tokenizer(f" {query}", add_special_tokens=False).input_ids)
 
 
-def llm(query):
+def generate_kwargs(queries, greedy=False, max_tokens=MAX_NEW_TOKENS, min_width=0):
+    """
+    Build model.generate kwargs for a batch of queries
+    - greedy=True uses deterministic greedy decoding (faster, no sampling)
+    - With COMPILE_LLM, the batch and width are padded to their shape
+      bucket (extra rows repeat the first prompt; callers drop them)
+    """
+    n = len(queries)
+
+    # Only the query itself is tokenized; decoder-only models need the
+    # prompts left-padded to a common width
+    rows = [[*PREFIX_IDS, *query_ids(q), *SUFFIX_IDS] for q in queries]
+    width = max(min_width, *(len(r) for r in rows))
+    if COMPILE_LLM:
+        rows += [rows[0]] * ((1 << (n - 1).bit_length()) - n)
+        width = -(-width // PROMPT_BUCKET) * PROMPT_BUCKET
+    pad = tokenizer.pad_token_id
+    prompt = torch.tensor([
+        [[pad] * (width - len(r)) + r for r in rows],
+        [[0] * (width - len(r)) + [1] * len(r) for r in rows],
+    ], dtype=torch.long)
+
+    # On GPU, ids + mask go over in one async copy from pinned host memory
+    if model.device.type == "cuda":
+        prompt = prompt.pin_memory().to(model.device, non_blocking=True)
+    input_ids, attention_mask = prompt
+
+    kwargs = dict(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        generation_config=GREEDY_CONFIG if greedy else SAMPLING_CONFIG
+    )
+    if max_tokens != MAX_NEW_TOKENS:
+        kwargs["max_new_tokens"] = max_tokens
+    # Prompt lookup needs a dynamic cache, so not with the compiled static one
+    if n == 1 and not COMPILE_LLM:
+        kwargs["prompt_lookup_num_tokens"] = PROMPT_LOOKUP_TOKENS
+    return kwargs
+
+
+def llm_batch(queries, greedy=False, max_tokens=MAX_NEW_TOKENS, min_width=0):
+    """
+    Generate responses for several queries with one padded
+    model.generate call
+    """
+    kwargs = generate_kwargs(queries, greedy, max_tokens, min_width)
+    out = model.generate(**kwargs)
+
+    # All rows share the padded prompt width: decode only the new tokens
+    # (and only for the real queries, not bucket filler rows)
+    new_ids = out[:len(queries), kwargs["input_ids"].shape[1]:]
+    return [clean(text) for text in tokenizer.batch_decode(new_ids, skip_special_tokens=True)]
+
+
+def llm(query, greedy=False, max_tokens=MAX_NEW_TOKENS):
     """
     Generate response using Qwen LLM
     """
-    prompt = f"User: {query}\nAssistant:"
-    inputs = tokenizer(prompt, return_tensors="pt")
+    return llm_batch([query], greedy, max_tokens)[0]
+
+
+# Longest wait for the next streamed chunk before giving up (seconds)
+STREAM_TIMEOUT = float(os.getenv("LLM_STREAM_TIMEOUT", "60"))
+
+# HF generation capacity shared by the batcher and /chat/stream: each
+# batched generate call or open stream holds one slot (a stream until its
+# generate thread has finished), and their blocking calls run on a
+# dedicated pool of the same size, so streams can neither oversubscribe
+# torch nor starve the default executor used by the batchers
+LLM_SLOTS = int(os.getenv("LLM_CONCURRENCY", "2"))
+_llm_slots = asyncio.Semaphore(LLM_SLOTS)
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_SLOTS, thread_name_prefix="llm")
+
+
+class StopOnEvent(StoppingCriteria):
+    """
+    Stops model.generate once the given threading.Event is set
+    """
+    def __init__(self, event):
+        self.event = event
 
-    out = model.generate(
-        **inputs,
-        max_new_tokens=150,
-        do_sample=True,
-        temperature=0.6,
-        top_p=0.9,
-        pad_token_id=tokenizer.eos_token_id
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full(
+            (input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device
+        )
+
+
+def llm_stream(query, greedy=False, max_tokens=MAX_NEW_TOKENS, stop=None):
+    """
+    Generate response using Qwen LLM, yielding raw text chunks
+    as soon as they are decoded (generation runs on a background thread)
+    - Setting `stop` (a threading.Event) ends generation early
+    - Errors raised by generate() are re-raised here once the stream ends
+    - Raises queue.Empty if no chunk arrives within STREAM_TIMEOUT
+    """
+    stop = stop or threading.Event()
+    streamer = TextIteratorStreamer(
+        tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=STREAM_TIMEOUT
     )
+    kwargs = generate_kwargs([query], greedy, max_tokens)
+    errors = []
+
+    def run():
+        try:
+            model.generate(
+                **kwargs,
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([StopOnEvent(stop)])
+            )
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # Always close the stream, or the consumer would wait forever
+            streamer.end()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield from streamer
+    finally:
+        # Also runs on close() / timeout: stop decoding and wait for the
+        # thread, so no generate() keeps running without a consumer
+        stop.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _close_stream(step, stream):
+    """
+    Wait for an in-flight next(stream) call, then close the stream
+    (which joins its generate thread)
+    """
+    if step is not None:
+        wait_futures([step])
+    stream.close()
 
-    return clean(tokenizer.decode(out[0], skip_special_tokens=True))
+# ======================================================
+# VLLM BACKEND (LLM_BACKEND=vllm)
+# vLLM batches concurrent requests itself, so these
+# bypass the micro-batcher
+# ======================================================
+
+def vllm_params(greedy=False, max_tokens=MAX_NEW_TOKENS):
+    """
+    vLLM equivalent of the generation settings above
+    """
+    sampling = {"temperature": 0} if greedy else {"temperature": 0.6, "top_p": 0.9}
+    return SamplingParams(
+        max_tokens=max_tokens,
+        output_kind=RequestOutputKind.DELTA,   # Yield only new text per step
+        **sampling
+    )
+
+
+async def vllm_stream(query, greedy=False):
+    """
+    Generate response with vLLM, yielding text deltas
+    """
+    prompt = PROMPT_PREFIX + " " + query + PROMPT_SUFFIX
+    async for out in engine.generate(prompt, vllm_params(greedy), str(uuid.uuid4())):
+        yield out.outputs[0].text
+
+
+async def vllm_generate(query, greedy=False):
+    """
+    Generate full response with vLLM
+    """
+    return clean("".join([delta async for delta in vllm_stream(query, greedy)]))
+
+
+async def llm_stream_async(query, greedy=False):
+    """
+    Async stream of response text chunks for either backend
+    """
+    if LLM_BACKEND == "vllm":
+        async for delta in vllm_stream(query, greedy):
+            yield delta
+        return
+
+    # Pull chunks off the HF streamer without blocking the event loop,
+    # holding a generation slot for the whole stream
+    loop = asyncio.get_running_loop()
+    stop = threading.Event()
+    async with _llm_slots:
+        stream = llm_stream(query, greedy, stop=stop)
+        step = None
+        try:
+            while True:
+                step = _llm_executor.submit(next, stream, None)
+                delta = await asyncio.wrap_future(step)
+                if delta is None:
+                    break
+                yield delta
+        finally:
+            # Client gone, error or done: stop generation and only release
+            # the slot once the generate thread has finished
+            stop.set()
+            await loop.run_in_executor(_llm_executor, _close_stream, step, stream)
+
+# ======================================================
+# MICRO-BATCHERS
+# Concurrent requests arriving within a short window are
+# merged into one model call:
+# - LLM: one model.generate (up to MAX_BATCH, BATCH_WAIT)
+# - Embedder: one embedder.encode (up to EMBED_BATCH, EMBED_WAIT)
+# ======================================================
+
+# Batch limits can be tuned per deployment (window in milliseconds)
+MAX_BATCH = int(os.getenv("LLM_MAX_BATCH", "8"))
+BATCH_WAIT = float(os.getenv("LLM_BATCH_WAIT_MS", "10")) / 1000
+
+EMBED_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))
+EMBED_WAIT = float(os.getenv("EMBED_BATCH_WAIT_MS", "5")) / 1000
+
+# Warm up the compiled model on every shape bucket requests can land in:
+# batch sizes 1, 2, 4, ... up to MAX_BATCH rounded up to a power of two,
+# times prompt widths PROMPT_BUCKET, 2 * PROMPT_BUCKET, ... up to
+# LLM_WARMUP_MAX_PROMPT tokens. Only model.forward is compiled, so greedy
+# vs sampled decoding shares the same graphs. Longer prompts compile their
+# bucket on first use; the dynamo recompile limit leaves room for those
+# instead of silently falling back to eager.
+WARMUP_MAX_PROMPT = int(os.getenv("LLM_WARMUP_MAX_PROMPT", "256"))
+
+if COMPILE_LLM:
+    _batch_buckets = [1 << i for i in range((MAX_BATCH - 1).bit_length() + 1)]
+    _width_buckets = range(PROMPT_BUCKET, WARMUP_MAX_PROMPT + 1, PROMPT_BUCKET)
+
+    # Each bucket compiles a prefill and a decode graph
+    torch._dynamo.config.cache_size_limit = max(
+        torch._dynamo.config.cache_size_limit,
+        2 * len(_batch_buckets) * (len(_width_buckets) + 4)
+    )
+    for _n in _batch_buckets:
+        for _width in _width_buckets:
+            llm_batch(["Hello"] * _n, greedy=True, min_width=_width)
+
+# Pending (query, greedy, future) triples waiting to be generated
+_llm_queue = asyncio.Queue()
+
+# Pending (text, future) pairs waiting to be embedded
+_embed_queue = asyncio.Queue()
+
+
+async def _collect_batch(queue, max_size, wait):
+    """
+    Wait for one queued item, then keep collecting until
+    the window closes or the batch is full
+    """
+    loop = asyncio.get_running_loop()
+    batch = [await queue.get()]
+
+    deadline = loop.time() + wait
+    while len(batch) < max_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+async def llm_async(query, greedy=False):
+    """
+    Queue a query for the batcher and wait for its response
+    (with vLLM, generate directly)
+    """
+    if LLM_BACKEND == "vllm":
+        return await vllm_generate(query, greedy)
+
+    fut = asyncio.get_running_loop().create_future()
+    await _llm_queue.put((query, greedy, fut))
+    return await fut
+
+
+async def _generate_group(group, greedy):
+    """
+    Generate one group of (query, greedy, future) items
+    and resolve their futures
+    """
+    # Run generation off the event loop so other endpoints stay responsive
+    loop = asyncio.get_running_loop()
+    try:
+        async with _llm_slots:
+            outputs = await loop.run_in_executor(
+                _llm_executor, llm_batch, [q for q, _, _ in group], greedy
+            )
+    except Exception as e:
+        for _, _, fut in group:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+
+    for (_, _, fut), response in zip(group, outputs):
+        if not fut.done():
+            fut.set_result(response)
+
+
+async def llm_batcher():
+    """
+    Background loop: collect a batch of queued queries,
+    generate them together, resolve each caller's future
+    """
+    while True:
+        batch = await _collect_batch(_llm_queue, MAX_BATCH, BATCH_WAIT)
+
+        # One generate call per decoding mode (greedy / sampled)
+        for greedy in (True, False):
+            group = [item for item in batch if item[1] == greedy]
+            if group:
+                await _generate_group(group, greedy)
+
+
+async def embed_async(text):
+    """
+    Queue a text for the embedding batcher and wait for its
+    normalized embedding
+    """
+    fut = asyncio.get_running_loop().create_future()
+    await _embed_queue.put((text, fut))
+    return await fut
+
+
+async def embed_batcher():
+    """
+    Background loop: collect a batch of queued texts,
+    encode them in one padded forward pass, resolve each future
+    """
+    while True:
+        batch = await _collect_batch(_embed_queue, EMBED_BATCH, EMBED_WAIT)
+
+        try:
+            embs = await asyncio.to_thread(
+                embedder.encode,
+                [t for t, _ in batch],
+                batch_size=EMBED_BATCH,
+                convert_to_tensor=True,
+                normalize_embeddings=True
+            )
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+
+        for (_, fut), emb in zip(batch, embs):
+            if not fut.done():
+                fut.set_result(emb)
 
 # ======================================================
 # TOOL FUNCTIONS
 # ======================================================
 
+SUICIDE_RESPONSE = (
+    "I'm really sorry you're feeling this way. "
+    "Please reach out to someone you trust or your local emergency services."
+)
+
+
 def suicide_tool(_):
     """
     Crisis / suicide support message
     """
-    return (
-        "I'm really sorry you're feeling this way. "
-        "Please reach out to someone you trust or your local emergency services."
-    )
+    return SUICIDE_RESPONSE
+
+
+_SUBS = ("Math", "Physics", "Chemistry", "English", "Biology")
+_rng_local = threading.local()
+
+
+def _marks_rng():
+    # One NumPy generator per thread: no shared RNG state or lock contention
+    rng = getattr(_rng_local, "rng", None)
+    if rng is None:
+        rng = _rng_local.rng = np.random.default_rng()
+    return rng
+
+
+# Reply layout is fixed, so build the format template once
+_MARKS_TMPL = "".join(f"{s}: {{}}/100\n" for s in _SUBS) + "Total: {}/500\nPercentage: {}%"
 
 
 def marks_tool(_):
     """
     Random student marks generator
     """
-    subs = ["Math", "Physics", "Chemistry", "English", "Biology"]
-    marks = {s: random.randint(40, 100) for s in subs}
-    total = sum(marks.values())
-    pct = round(total / len(subs), 2)
-
-    reply = "\n".join([f"{s}: {m}/100" for s, m in marks.items()])
-    return f"{reply}\nTotal: {total}/500\nPercentage: {pct}%"
+    marks = _marks_rng().integers(40, 101, size=len(_SUBS)).tolist()  # One RNG call for all subjects
+    total = sum(marks)
+    pct = round(total / len(_SUBS), 2)
+    return _MARKS_TMPL.format(*marks, total, pct)
 
 # Tools dictionary: maps tool name → function + description
 tools = {
@@ -103,12 +636,14 @@ tools = {
     ),
     "PositivePrompt": Tool(
         name="PositivePrompt",
-        func=lambda x: llm(x),
+        func=llm,
+        coroutine=llm_async,
         description="Motivational or comforting responses for stressed users."
     ),
     "NegativePrompt": Tool(
         name="NegativePrompt",
-        func=lambda x: llm(x),
+        func=llm,
+        coroutine=llm_async,
         description="Responses for anxiety, worry, or fear."
     ),
     "StudentMarks": Tool(
@@ -118,83 +653,291 @@ tools = {
     ),
 }
 
+# Plain dispatch table used on the request path (the Tool wrappers above
+# are only needed for their descriptions). LLM tools map to the async
+# batched generator, the others to plain functions.
+TOOL_FUNCS = {
+    "SuicideHelp": suicide_tool,
+    "PositivePrompt": llm_async,
+    "NegativePrompt": llm_async,
+    "StudentMarks": marks_tool,
+}
+
+# Tool descriptions never change, so embed them once at startup
+# instead of re-encoding all of them on every request
+TOOL_NAMES = list(tools)
+TOOL_EMB = embedder.encode(
+    [tools[n].description for n in TOOL_NAMES],
+    convert_to_tensor=True,
+    normalize_embeddings=True
+)
+
 # ======================================================
 # INTELLIGENT ROUTER
 # ======================================================
 
-def route(user: str):
+async def route(user: str, session_id):
     """
     Intelligent routing function:
-    - Uses semantic embeddings + conversation context
+    - Obvious keywords are routed directly by one automaton scan
+    - Otherwise uses semantic embeddings + conversation context
     - Chooses the most relevant tool automatically
-    - Does NOT expose similarity scores
+    - Returns (tool_name, confidence); scores are never sent to the client
     """
 
-    # 1. Get user input and clean
+    # 1. Keyword fast path (full confidence)
+    tool_name = keyword_route(user)
+    if tool_name:
+        return tool_name, 1.0
+
+    # 2. Get user input and clean
     user_message = user.strip()
 
-    # 2. Fetch recent conversation context (last 3 user + 3 AI messages)
-    context_messages = memory.chat_memory.messages[-6:]
-    context_text = " ".join([msg.content for msg in context_messages])
+    # 3. Fetch recent conversation context (last 3 user + 3 AI messages)
+    context_text = " ".join(text for _, text in list(SESSIONS.get(session_id, ()))[-6:])
 
-    # 3. Combine context + current message
+    # 4. Combine context + current message
     combined_text = f"{context_text} {user_message}".strip()
 
-    # 4. Encode user+context to embedding
-    user_embedding = embedder.encode(combined_text, convert_to_tensor=True)
-
-    # 5. Compare with each tool description (cosine similarity)
-    best_tool = "PositivePrompt"  # default
-    best_score = -1
+    # 5. Encode user+context to embedding
+    user_embedding = await embed_async(combined_text)
 
-    for tool_name, tool_obj in tools.items():
-        tool_embedding = embedder.encode(tool_obj.description, convert_to_tensor=True)
-        score = util.cos_sim(user_embedding, tool_embedding).item()
-        if score > best_score:
-            best_score = score
-            best_tool = tool_name
+    # 6. Compare against all precomputed tool embeddings in one shot
+    scores = util.cos_sim(user_embedding, TOOL_EMB)[0]
+    best_tool = TOOL_NAMES[int(scores.argmax())]
 
-    # 6. Fallback: low similarity → PositivePrompt
+    # 7. Fallback: low similarity → PositivePrompt
+    best_score = scores.max().item()
     if best_score < 0.4:
         best_tool = "PositivePrompt"
 
-    return best_tool
+    return best_tool, best_score
+
+# ======================================================
+# RESPONSE CACHES
+# Exact-match LRU first, then semantic (embedding) lookup
+# ======================================================
+
+def cache_lookup(tool_name, q_emb):
+    """
+    Return the cached response of the nearest past query for this tool
+    if it is similar enough (cosine >= CACHE_THRESHOLD), else None
+    """
+    if tool_name not in _semantic_cache:
+        return None
+    embs, resps = _semantic_cache[tool_name]
+    scores = util.cos_sim(q_emb, embs)[0]
+    if scores.max().item() < CACHE_THRESHOLD:
+        return None
+    return resps[int(scores.argmax())]
+
+
+def cache_store(tool_name, q_emb, response):
+    """
+    Add a query embedding + response to the tool's cache,
+    dropping the oldest entries beyond CACHE_SIZE
+    """
+    embs, resps = _semantic_cache.get(tool_name, (q_emb.new_empty(0, q_emb.shape[-1]), []))
+    _semantic_cache[tool_name] = (
+        torch.cat([embs, q_emb.unsqueeze(0).to(embs)])[-CACHE_SIZE:],
+        (resps + [response])[-CACHE_SIZE:]
+    )
+
+
+def _exact_key(tool_name, user):
+    # Case/whitespace variants of the same message share one entry
+    return tool_name, user.lower().strip()
+
+
+async def cache_get(tool_name, user):
+    """
+    Look up a cached response for an LLM query.
+    Returns (response or None, query embedding or None);
+    the embedding is only computed on an exact-match miss.
+    """
+    key = _exact_key(tool_name, user)
+    if key in _exact_cache:
+        _exact_cache.move_to_end(key)
+        return _exact_cache[key], None
+
+    q_emb = await embed_async(user)
+    return cache_lookup(tool_name, q_emb), q_emb
+
+
+def cache_put(tool_name, user, q_emb, response):
+    """
+    Store a freshly generated response in both caches
+    """
+    _exact_cache[_exact_key(tool_name, user)] = response
+    if len(_exact_cache) > EXACT_CACHE_SIZE:
+        _exact_cache.popitem(last=False)
+    cache_store(tool_name, q_emb, response)
+
+# ======================================================
+# HISTORY STORE
+# Redis list (newest first, trimmed to HISTORY_SIZE)
+# or the in-process deque when Redis is not configured
+# ======================================================
+
+async def add_history(entry):
+    """
+    Append one chat entry to history
+    """
+    if history_store is None:
+        conversation_history.append(entry)
+        return
+    async with history_store.pipeline(transaction=False) as pipe:
+        pipe.lpush(HISTORY_KEY, json.dumps(entry))
+        pipe.ltrim(HISTORY_KEY, 0, HISTORY_SIZE - 1)
+        await pipe.execute()
+
+
+async def get_history():
+    """
+    Return all stored entries, oldest first
+    """
+    if history_store is None:
+        return list(conversation_history)
+    return [json.loads(e) for e in reversed(await history_store.lrange(HISTORY_KEY, 0, -1))]
+
+
+async def get_latest():
+    """
+    Return the most recent entry, or None if there is no history
+    """
+    if history_store is None:
+        return conversation_history[-1] if conversation_history else None
+    entry = await history_store.lindex(HISTORY_KEY, 0)
+    return json.loads(entry) if entry else None
 
 # ======================================================
 # MAIN CHAT HANDLER
 # ======================================================
 
-def process_message(user: str):
+def get_memory(session_id):
     """
-    Main function to process user input:
-    - Determines the best tool using intelligent routing
-    - Executes the selected tool
-    - Stores conversation in LangChain memory
-    - Stores conversation in global history
-    - Returns clean JSON: session_id, tool_used, response
+    LangChain message view of a session's conversation memory,
+    built only when something needs it
     """
+    return [
+        HumanMessage(content=text) if role == "user" else AIMessage(content=text)
+        for role, text in SESSIONS.get(session_id, ())
+    ]
 
-    # 1. Route to correct tool
-    tool_name = route(user)
 
-    # 2. Execute the tool function
-    bot_response = tools[tool_name].func(user)
+def session_turns(session_id):
+    """
+    Get (or create) a session's memory and mark it most recently used
+    """
+    turns = SESSIONS.get(session_id)
+    if turns is None:
+        turns = SESSIONS[session_id] = deque(maxlen=SESSION_TURNS)
+        if len(SESSIONS) > MAX_SESSIONS:
+            SESSIONS.popitem(last=False)
+    else:
+        SESSIONS.move_to_end(session_id)
+    return turns
+
 
-    # 3. Store conversation in LangChain memory
-    memory.chat_memory.add_user_message(user)
-    memory.chat_memory.add_ai_message(bot_response)
+async def save_turn(user, tool_name, bot_response, session_id):
+    """
+    Store a finished turn:
+    - LLM turns go to the session's memory (used as routing context)
+    - Every turn goes to global history
+    """
+    if tool_name not in DIRECT_TOOLS:
+        turns = session_turns(session_id)
+        turns.append(("user", user))
+        turns.append(("ai", bot_response))
 
-    # 4. Store conversation in global history
-    conversation_history.append({
-        "session_id": SESSION_ID,
+    await add_history({
+        "session_id": session_id,
         "user_message": user,
         "bot_response": bot_response,
         "tool_used": tool_name
     })
 
-    # 5. Return clean JSON
+
+async def process_message(user: str, session_id=None, background_tasks=None):
+    """
+    Main function to process user input:
+    - Determines the best tool using intelligent routing
+    - Serves repeated / near-duplicate LLM queries from the response caches
+    - Executes the selected tool
+    - Stores the turn in memory + global history
+      (after the response is sent, if FastAPI BackgroundTasks are given)
+    - Returns clean JSON: session_id, tool_used, response
+    """
+    # New conversations get their own id, returned to the client
+    session_id = session_id or str(uuid.uuid4())
+
+    # 1. Route to correct tool
+    tool_name, confidence = await route(user, session_id)
+
+    # 2. Execute the tool function
+    if tool_name in DIRECT_TOOLS:
+        # Fast path: no embedding, no cache, no memory writes
+        bot_response = TOOL_FUNCS[tool_name](user)
+    else:
+        # LLM tools go through the response caches
+        bot_response, q_emb = await cache_get(tool_name, user)
+        if bot_response is None:
+            greedy = confidence >= GREEDY_CONFIDENCE
+            bot_response = await TOOL_FUNCS[tool_name](user, greedy=greedy)
+            cache_put(tool_name, user, q_emb, bot_response)
+
+    # 3. Store conversation off the critical path when possible
+    #    (save_turn runs on the event loop, so writes stay serialized)
+    if background_tasks is not None:
+        background_tasks.add_task(save_turn, user, tool_name, bot_response, session_id)
+    else:
+        await save_turn(user, tool_name, bot_response, session_id)
+
+    # 4. Return clean JSON
     return {
-        "session_id": SESSION_ID,
+        "session_id": session_id,
         "tool": tool_name,
         "response": bot_response
     }
+
+
+async def process_message_stream(user: str, session_id=None):
+    """
+    Streaming version of process_message. Yields events:
+    - { "session_id": "...", "tool": "..." }   once routing is done
+    - { "delta": "..." }                       for each generated text chunk
+    - { "response": "...", "done": true }      final cleaned response
+    - { "error": "..." }                       instead, if generation fails
+    The turn is stored in memory/history after generation finishes.
+    """
+    # New conversations get their own id, returned to the client
+    session_id = session_id or str(uuid.uuid4())
+
+    # 1. Route to correct tool
+    tool_name, confidence = await route(user, session_id)
+    yield {"session_id": session_id, "tool": tool_name}
+
+    # 2. Execute the tool function
+    if tool_name in DIRECT_TOOLS:
+        bot_response = TOOL_FUNCS[tool_name](user)
+    else:
+        bot_response, q_emb = await cache_get(tool_name, user)
+        if bot_response is None:
+            chunks = []
+            try:
+                async for delta in llm_stream_async(user, greedy=confidence >= GREEDY_CONFIDENCE):
+                    chunks.append(delta)
+                    yield {"delta": delta}
+            except Exception:
+                # generate() failed or stalled (queue.Empty): tell the client
+                # instead of ending with a cut-off reply; nothing is stored
+                yield {"error": "The reply could not be generated, please try again."}
+                return
+            bot_response = clean("".join(chunks))
+            cache_put(tool_name, user, q_emb, bot_response)
+
+    # 3. Store conversation
+    await save_turn(user, tool_name, bot_response, session_id)
+
+    # 4. Final cleaned response
+    yield {"response": bot_response, "done": True}
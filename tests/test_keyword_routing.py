@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from keyword_routing import keyword_route
+
+
+@pytest.mark.parametrize("message", [
+    "The job market makes me anxious",
+    "My marketing job is overwhelming me",
+    "Markus left me and I'm worried",
+    "He scored my heart, I feel sad",
+])
+def test_longer_words_do_not_route_to_marks(message):
+    assert keyword_route(message) != "StudentMarks"
+
+
+@pytest.mark.parametrize("message", [
+    "What are my marks?",
+    "Show my score",
+    "Are the results out",
+])
+def test_whole_mark_keywords_route_to_marks(message):
+    assert keyword_route(message) == "StudentMarks"
+
+
+def test_part_of_word_falls_through_to_next_keyword():
+    assert keyword_route("The job market makes me anxious") == "NegativePrompt"
+
+
+def test_crisis_phrase_wins_over_other_keywords():
+    assert keyword_route("My marks are bad and I want to die") == "SuicideHelp"
+
+
+def test_no_keyword_returns_none():
+    assert keyword_route("Hello there") is None